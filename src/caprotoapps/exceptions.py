@@ -2,3 +2,15 @@ class NotPermitted(RuntimeError):
     """This requested operation is not allowed due to IOC configuration."""
 
     ...
+
+
+class RemoteTimeout(TimeoutError):
+    """The IOC's control script did not finish in the allotted time."""
+
+    ...
+
+
+class RemoteConnectionError(ConnectionError):
+    """Could not connect to the host running the IOC's control script."""
+
+    ...
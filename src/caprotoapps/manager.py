@@ -12,50 +12,61 @@ Example usage:
 """
 
 import asyncio
-import enum
-import getpass
-import grp
+import atexit
+import functools
+import hashlib
 import logging
 import os
 import re
-import socket
-import struct
+import shlex
 import subprocess
-import sys
-import time
-from collections import OrderedDict
-
-#!/usr/bin/env python3
-from contextlib import contextmanager
+import tempfile
 from enum import IntEnum
-from functools import partial
 from pathlib import Path
-from subprocess import PIPE, STDOUT
-from threading import Lock
-from typing import Mapping, Optional, Sequence
+from subprocess import DEVNULL, PIPE, STDOUT
+from typing import Optional
 
+import asyncssh
 from caproto import ChannelType, SkipWrite
-from caproto.server import (
-    PVGroup,
-    PvpropertyChar,
-    PvpropertyDouble,
-    PvpropertyShort,
-    PvpropertyShortRO,
-    SubGroup,
-    pvproperty,
-    scan_wrapper,
-)
-from fabric import Connection
+from caproto.server import PVGroup, pvproperty
 
 from . import exceptions
 
 log = logging.getLogger(__name__)
 
 
+# Maximum time (in seconds) to wait for a control script to finish
+RUNNER_TIMEOUT = 30.0
+
+# Options for failing fast, instead of hanging, on unreachable hosts
+SSH_OPTIONS = [
+    "-o",
+    "ConnectTimeout=5",
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ServerAliveInterval=15",
+    "-o",
+    "ServerAliveCountMax=3",
+]
+
+# Persistent SSH connections, shared by all runners for a given (user, host)
+_ssh_connections: dict[tuple[str, str], asyncssh.SSHClientConnection] = {}
+_ssh_connection_locks: dict[tuple[str, str], asyncio.Lock] = {}
+
+# ControlMaster sockets that will be shut down when the process exits
+_ssh_control_paths: set[Path] = set()
+
+# Limits simultaneous SSH handshakes to stay below sshd's MaxStartups
+_ssh_handshake_semaphore = asyncio.Semaphore(
+    int(os.environ.get("CAPROTOAPPS_MAX_SSH", "8"))
+)
+
+
 script_re = re.compile(
-    "^(?:(?P<user>.+)@)?"  # Username (optional)
-    "(?:(?P<host>.+):)?"  # Host (optional)
-    "(?P<path>/.+)$"  # Script location
+    "(?:(?P<user>[^@]+)@)?"  # Username (optional)
+    "(?:(?P<host>[^:@/]+):)?"  # Host (optional)
+    "(?P<path>/.+)"  # Script location
 )
 
 
@@ -77,7 +88,9 @@ def parse_script_location(
     script
       The location of the script for starting/stopping the IOC
     """
-    match = script_re.match(script)
+    match = script_re.fullmatch(script)
+    if match is None:
+        raise ValueError(f"Could not parse script location: {script}")
     # Extract matched groups
     user = match.group("user")
     host = match.group("host")
@@ -92,24 +105,36 @@ class IOCStatus(IntEnum):
     Stopped = 1
     Running = 2
 
+    @classmethod
+    def from_response(cls, response: str) -> "IOCStatus":
+        """Parse the output of a BCDA script's "status" command."""
+        if " is not running" in response:
+            return cls.Stopped
+        if " is running" in response:
+            return cls.Running
+        return cls.Unknown
+
 
 class BaseRunner:
     def __init__(self, script_path: Path):
         self.script_path = script_path
+        # Only one call to the control script at a time
+        self._lock = asyncio.Lock()
+        self._pending_status: Optional[asyncio.Future] = None
 
-    def start_ioc(self):
+    async def start_ioc(self):
         """Start the managed IOC."""
         raise NotImplementedError
 
-    def stop_ioc(self):
+    async def stop_ioc(self):
         """Stop the managed."""
         raise NotImplementedError
 
-    def restart_ioc(self):
+    async def restart_ioc(self):
         """Restart the managed IOC."""
         raise NotImplementedError
 
-    def ioc_status(self) -> int:
+    async def ioc_status(self) -> int:
         """Determine whether the IOC is running.
 
         Returns
@@ -120,37 +145,102 @@ class BaseRunner:
         """
         raise NotImplementedError
 
-    def execute_script(self, args):
+    async def execute_script(self, args):
         """Execute *args* on target machine."""
         raise NotImplementedError
 
 
 class BCDARunner(BaseRunner):
-    def __init__(self, script_path: Path):
-        self.script_path = script_path
-
-    def execute_script(self, args):
+    async def execute_script(self, args):
         """Execute *args* on local machine."""
-        result = subprocess.run(args, stdout=PIPE, stderr=STDOUT)
-        response = result.stdout.decode("utf-8").strip()
+        returncode, response = await self._run_subprocess(args)
+        return response
+
+    async def _run_subprocess(self, args) -> tuple[int, str]:
+        """Run *args* as a local process.
+
+        Returns
+        =======
+        returncode
+          The exit status of the process.
+        response
+          The last non-empty line of output.
+
+        """
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=PIPE, stderr=STDOUT
+            )
+        except OSError as exc:
+            raise exceptions.RemoteConnectionError(
+                f"Could not execute {args[0]}: {exc}"
+            ) from exc
+        try:
+            response = await asyncio.wait_for(
+                self._wait_for_output(proc), timeout=RUNNER_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            raise exceptions.RemoteTimeout(f"Timed out executing {args}")
+        finally:
+            # Don't leave the process behind if anything went wrong
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        return proc.returncode, response
+
+    async def _wait_for_output(self, proc) -> str:
+        """Stream *proc*'s output, then wait for it to exit."""
+        response = await self._stream_output(proc.stdout)
+        await proc.wait()
         return response
 
-    def start_ioc(self):
+    async def _stream_output(self, stdout) -> str:
+        """Log the script's output as it arrives.
+
+        Returns
+        =======
+        response
+          The last non-empty line of output.
+
+        """
+        response = ""
+        lines = aiter(stdout)
+        while True:
+            try:
+                line = await anext(lines)
+            except StopAsyncIteration:
+                break
+            except ValueError:
+                # Longer than the stream's buffer limit, so it gets dropped
+                log.warning(f"{self.script_path}: skipped overlong output line")
+                continue
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", errors="replace")
+            line = line.strip()
+            if line:
+                log.debug(f"{self.script_path}: {line}")
+                response = line
+        return response
+
+    async def start_ioc(self):
         """Start the managed IOC."""
         run_args = [str(self.script_path), "start"]
-        self.execute_script(args=run_args)
+        async with self._lock:
+            await self.execute_script(args=run_args)
 
-    def stop_ioc(self):
+    async def stop_ioc(self):
         """Stop the managed."""
         run_args = [str(self.script_path), "stop"]
-        self.execute_script(args=run_args)
+        async with self._lock:
+            await self.execute_script(args=run_args)
 
-    def restart_ioc(self):
+    async def restart_ioc(self):
         """Restart the managed IOC."""
         run_args = [str(self.script_path), "restart"]
-        self.execute_script(args=run_args)
+        async with self._lock:
+            await self.execute_script(args=run_args)
 
-    def ioc_status(self) -> int:
+    async def ioc_status(self) -> int:
         """Determine whether the IOC is running.
 
         Returns
@@ -159,45 +249,209 @@ class BCDARunner(BaseRunner):
           The running status of the IOC, based on ``IOCStatus`` enum.
 
         """
+        # Share the result with any concurrent status requests
+        if self._pending_status is None:
+            self._pending_status = asyncio.ensure_future(self._query_status())
+            self._pending_status.add_done_callback(self._clear_pending_status)
+        return await asyncio.shield(self._pending_status)
+
+    def _clear_pending_status(self, future):
+        self._pending_status = None
+
+    async def _query_status(self) -> int:
+        """Run the script's "status" command and parse the response."""
         run_args = [str(self.script_path), "status"]
-        response = self.execute_script(run_args)
+        try:
+            async with self._lock:
+                response = await self.execute_script(run_args)
+        except (exceptions.RemoteTimeout, exceptions.RemoteConnectionError) as exc:
+            log.warning(f"Could not determine IOC status: {exc}")
+            return IOCStatus.Unknown
         # Parse the status response
-        match = re.match(r"^\S+ is (not)? ?running", response)
-        if match is None:
+        status = IOCStatus.from_response(response)
+        if status == IOCStatus.Unknown:
             # Garbled response
             log.warning(f"Could not parse IOC status response: {response}")
-            return IOCStatus.Unknown
-        # Determine the status from the response
-        is_stopped = match.group(1) == "not"
-        if is_stopped:
-            return IOCStatus.Stopped
-        else:
-            return IOCStatus.Running
+        return status
 
 
 class BCDASSHRunner(BCDARunner):
-    ssh_connection: Connection = None
+    """Runs the BCDA script on a remote host over SSH.
 
-    def __init__(self, user: str, host: str, script_path: Path):
+    A single SSH connection is kept open for each (user, host) pair
+    and re-used by all runners pointing at that host.
+
+    The host key is checked against ``~/.ssh/known_hosts`` unless
+    *verify_host_key* is false.
+
+    """
+
+    def __init__(
+        self, user: str, host: str, script_path: Path, verify_host_key: bool = True
+    ):
         self.user = user
         self.host = host
+        self.verify_host_key = verify_host_key
         super().__init__(script_path=script_path)
 
-    def execute_script(self, args):
-        """Execute *args* on local machine."""
-        # Establish connection
-        if self.ssh_connection is None:
-            self.ssh_connection = Connection(host=self.host, user=self.user)
-        # Send command to the remote host
-        cmd = " ".join(args)
-        result = self.ssh_connection.run(cmd, hide="out")
-        # Parse the response
-        response = result.stdout.strip()
+    async def _get_conn(self) -> asyncssh.SSHClientConnection:
+        """Retrieve the pooled SSH connection, connecting if necessary."""
+        key = (self.user, self.host)
+        lock = _ssh_connection_locks.get(key)
+        if lock is None:
+            lock = _ssh_connection_locks[key] = asyncio.Lock()
+        async with lock:
+            conn = _ssh_connections.get(key)
+            if conn is None:
+                log.debug(f"Opening SSH connection to {self.user}@{self.host}")
+                # Skipping host key verification must be explicitly requested
+                options = {} if self.verify_host_key else {"known_hosts": None}
+                async with _ssh_handshake_semaphore:
+                    conn = await asyncssh.connect(
+                        self.host,
+                        username=self.user,
+                        connect_timeout=5,
+                        keepalive_interval=30,
+                        keepalive_count_max=3,
+                        **options,
+                    )
+                _ssh_connections[key] = conn
+        return conn
+
+    async def _evict_conn(self, conn: asyncssh.SSHClientConnection):
+        """Remove a lost connection from the pool."""
+        key = (self.user, self.host)
+        if _ssh_connections.get(key) is conn:
+            del _ssh_connections[key]
+        conn.close()
+
+    async def _open_process(self, cmd: str) -> asyncssh.SSHClientProcess:
+        """Start *cmd* over the pooled connection.
+
+        If the pooled connection has been lost, reconnect and try once
+        more. Nothing is retried once the command has started, since
+        the control script's actions are not safe to repeat.
+
+        """
+        conn = await self._get_conn()
+        try:
+            return await conn.create_process(cmd, stderr=asyncssh.STDOUT)
+        except (asyncssh.ChannelOpenError, asyncssh.ConnectionLost):
+            if not conn.is_closed():
+                # sshd refused the channel (e.g. MaxSessions), but the
+                # connection is still in use by other runners
+                raise
+            log.info(f"Lost SSH connection to {self.host}, reconnecting.")
+            await self._evict_conn(conn)
+            conn = await self._get_conn()
+            return await conn.create_process(cmd, stderr=asyncssh.STDOUT)
+
+    async def execute_script(self, args):
+        """Execute *args* on the remote host."""
+        cmd = shlex.join(args)
+        try:
+            response = await asyncio.wait_for(
+                self._run_remote(cmd), timeout=RUNNER_TIMEOUT
+            )
+        except (TimeoutError, asyncio.TimeoutError) as exc:
+            raise exceptions.RemoteTimeout(
+                f"Timed out executing {cmd} on {self.user}@{self.host}"
+            ) from exc
+        except (OSError, asyncssh.Error) as exc:
+            raise exceptions.RemoteConnectionError(
+                f"Could not connect to {self.user}@{self.host}: {exc}"
+            ) from exc
         return response
 
+    async def _run_remote(self, cmd: str) -> str:
+        """Run *cmd* on the remote host, streaming its output."""
+        proc = await self._open_process(cmd)
+        async with proc:
+            return await self._stream_output(proc.stdout)
+
+
+class BCDAOpenSSHRunner(BCDARunner):
+    """Runs the BCDA script on a remote host using the ``ssh`` command.
+
+    An alternative to ``BCDASSHRunner`` for when asyncssh is not
+    suitable. OpenSSH connection multiplexing (ControlMaster) is used,
+    so only the first call pays for the SSH handshake and later calls
+    re-use the master connection.
+
+    """
+
+    control_persist: int = 600  # Seconds to keep idle master alive
+
+    def __init__(self, user: str, host: str, script_path: Path):
+        self.user = user
+        self.host = host
+        # Hash user and host so long host names cannot push the socket
+        # path past the ~108 byte limit for Unix sockets
+        digest = hashlib.sha1(f"{user}@{host}".encode()).hexdigest()[:16]
+        self.control_path = Path(tempfile.gettempdir()) / f"caproto-alive-{digest}.sock"
+        # Runners for the same host share a master, so only close it once
+        if self.control_path not in _ssh_control_paths:
+            _ssh_control_paths.add(self.control_path)
+            atexit.register(_close_ssh_master, self.control_path, f"{user}@{host}")
+        super().__init__(script_path=script_path)
+
+    def ssh_args(self) -> list[str]:
+        """Build the arguments to run ``ssh`` through the master."""
+        return [
+            "ssh",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            f"ControlPersist={self.control_persist}",
+            *SSH_OPTIONS,
+            f"{self.user}@{self.host}",
+        ]
+
+    async def execute_script(self, args):
+        """Execute *args* on the remote host."""
+        cmd = shlex.join(args)
+        returncode, response = await self._run_subprocess([*self.ssh_args(), cmd])
+        # ssh exits with 255 for its own errors (e.g. unreachable host)
+        if returncode == 255:
+            raise exceptions.RemoteConnectionError(
+                f"Could not connect to {self.user}@{self.host}: {response}"
+            )
+        return response
 
+    def close_master(self):
+        """Shut down the master SSH connection, if one is running."""
+        _close_ssh_master(self.control_path, f"{self.user}@{self.host}")
+
+
+def _close_ssh_master(control_path: Path, target: str):
+    """Shut down the master SSH connection at *control_path*, if running."""
+    if not control_path.exists():
+        return
+    exit_args = [
+        "ssh",
+        "-o",
+        f"ControlPath={control_path}",
+        *SSH_OPTIONS,
+        "-O",
+        "exit",
+        target,
+    ]
+    try:
+        subprocess.run(exit_args, stdout=DEVNULL, stderr=DEVNULL, timeout=5)
+    except subprocess.TimeoutExpired:
+        log.warning(f"Timed out closing SSH master connection to {target}")
+
+
+@functools.lru_cache(maxsize=128)
 def guess_runner(script: str):
-    """Determine which IOC runner to use based on the script type."""
+    """Determine which IOC runner to use based on the script type.
+
+    Runners are cached, so managers for the same script share a runner
+    (and therefore its lock and SSH connection).
+
+    """
     user, host, path = parse_script_location(script)
     # Check for SSH connections (BCDA style)
     use_ssh = (user is not None) and (host is not None)
@@ -207,6 +461,33 @@ def guess_runner(script: str):
     return BCDARunner(script_path=path)
 
 
+def _make_trigger(
+    name: str, method_name: str, requires: tuple[str, ...], denied_msg: str, doc: str
+) -> pvproperty:
+    """Build a PV that calls the runner's *method_name* when written.
+
+    The trigger is only allowed if all the PVs named in *requires* are
+    "On", otherwise ``NotPermitted`` is raised with *denied_msg*.
+
+    """
+    trigger = pvproperty(name=name, value="Off", dtype=bool, doc=doc)
+
+    async def putter(self, instance, value):
+        # Confirm we are allowed to change the IOC's state
+        if any(getattr(self, perm).value != "On" for perm in requires):
+            raise exceptions.NotPermitted(denied_msg)
+        # Execute the runner's control function
+        try:
+            await getattr(self.runner, method_name)()
+        except (exceptions.RemoteTimeout, exceptions.RemoteConnectionError) as exc:
+            log.error(f"Could not {name} IOC: {exc}")
+            raise SkipWrite()
+        # Return the trigger to its default value
+        return "Off"
+
+    return trigger.putter(putter)
+
+
 class ManagerGroup(PVGroup):
     """A caproto PV group for managing a separate IOC.
 
@@ -259,28 +540,16 @@ class ManagerGroup(PVGroup):
         is_startable = "On" if self.allow_start else "Off"
         await instance.write(is_startable)
 
-    start = pvproperty(
-        name="start", value="Off", dtype=bool, doc="Start the remote IOC."
+    start = _make_trigger(
+        "start",
+        "start_ioc",
+        requires=("startable",),
+        denied_msg=(
+            "Cannot start IOC. Provide *allow_start=True* to enable remote " "starting."
+        ),
+        doc="Start the remote IOC.",
     )
 
-    @start.putter
-    async def start(self, instance, value):
-        """Trigger a remote IOC to start."""
-        # Confirm we are allow to start the IOC
-        if self.startable.value != "On":
-            msg = "Cannot start IOC. Provide *allow_start=True* to enable remote starting."
-            raise exceptions.NotPermitted(msg)
-        # Execute the runner's control function
-        loop = self.async_lib.get_running_loop()
-        await loop.run_in_executor(None, self.runner.start_ioc)
-        # Return the trigger to its default value
-        return "Off"
-
-    @start.startup
-    async def start(self, instance, async_lib):
-        # Just here to get the async lib on startup
-        self.async_lib = async_lib.library
-
     # PVs for changing the IOC state
     stoppable = pvproperty(
         name="stoppable",
@@ -295,39 +564,26 @@ class ManagerGroup(PVGroup):
         is_stoppable = "On" if self.allow_stop else "Off"
         await instance.write(is_stoppable)
 
-    stop = pvproperty(name="stop", value="Off", dtype=bool, doc="Stop the remote IOC.")
-
-    @stop.putter
-    async def stop(self, instance, value):
-        # Confirm we are allow to start the IOC
-        if self.stoppable.value != "On":
-            msg = (
-                "Cannot stop IOC. Provide *allow_stop=True* to enable remote stopping."
-            )
-            raise exceptions.NotPermitted(msg)
-        # Execute the runner's control function
-        loop = self.async_lib.get_running_loop()
-        await loop.run_in_executor(None, self.runner.stop_ioc)
-        # Return the trigger to its default value
-        return "Off"
-
-    restart = pvproperty(
-        name="restart", value="Off", dtype=bool, doc="Restart the remote IOC."
+    stop = _make_trigger(
+        "stop",
+        "stop_ioc",
+        requires=("stoppable",),
+        denied_msg=(
+            "Cannot stop IOC. Provide *allow_stop=True* to enable remote " "stopping."
+        ),
+        doc="Stop the remote IOC.",
     )
 
-    @restart.putter
-    async def restart(self, instance, value):
-        # Confirm we are allowed to restart the IOC
-        if (self.startable.value != "On") or (self.stoppable.value != "On"):
-            msg = (
-                "Cannot stop IOC. Provide *allow_stop=True* to enable remote stopping."
-            )
-            raise exceptions.NotPermitted(msg)
-        # Execute the runner's control function
-        loop = self.async_lib.get_running_loop()
-        await loop.run_in_executor(None, self.runner.restart_ioc)
-        # Return the trigger to its default value
-        return "Off"
+    restart = _make_trigger(
+        "restart",
+        "restart_ioc",
+        requires=("startable", "stoppable"),
+        denied_msg=(
+            "Cannot restart IOC. Provide *allow_start=True* and *allow_stop=True* "
+            "to enable remote restarting."
+        ),
+        doc="Restart the remote IOC.",
+    )
 
     # PVs for monitoring the IOC state
     status = pvproperty(
@@ -339,10 +595,9 @@ class ManagerGroup(PVGroup):
         doc="The current status of the IOC.",
     )
 
-    @status.scan(1, use_scan_field=True)
+    @status.scan(5.0, use_scan_field=True)
     async def status(self, instance, async_lib):
-        loop = self.async_lib.get_running_loop()
-        new_status = await loop.run_in_executor(None, self.runner.ioc_status)
+        new_status = await self.runner.ioc_status()
         old_status = getattr(IOCStatus, instance.value)
         if new_status != old_status:
             await instance.write(new_status)
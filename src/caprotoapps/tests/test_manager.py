@@ -1,4 +1,5 @@
 import asyncio
+import sys
 from pathlib import Path
 from unittest import mock
 
@@ -26,12 +27,52 @@ class MockIOC(PVGroup):
     )
 
 
+class FakeSSHProcess:
+    """Stands in for an asyncssh process that prints *output*.
+
+    If *error* is given, it is raised after the output is printed.
+
+    """
+
+    def __init__(self, output, error=None):
+        self.stdout = self._stream(output, error)
+
+    async def _stream(self, output, error):
+        for line in output.splitlines(keepends=True):
+            yield line
+        if error is not None:
+            raise error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+def mock_ssh_connection(output):
+    """Build a fake asyncssh connection whose processes print *output*."""
+    conn = mock.MagicMock()
+    conn.is_closed.return_value = False
+    conn.create_process = mock.AsyncMock(
+        side_effect=lambda cmd, **kwargs: FakeSSHProcess(output)
+    )
+    return conn
+
+
+@pytest.fixture(autouse=True)
+def ssh_pool():
+    """Start each test with an empty SSH connection pool."""
+    yield
+    manager._ssh_connections.clear()
+    manager._ssh_connection_locks.clear()
+
+
 @pytest.fixture
 def mock_ioc():
     ioc = MockIOC(prefix="test_ioc:")
     for group in [ioc.manager_rw, ioc.manager_ro]:
-        group.runner = mock.MagicMock()
-        group.async_lib = asyncio
+        group.runner = mock.AsyncMock()
     yield ioc
 
 
@@ -61,11 +102,28 @@ def test_parse_local_script_location():
     assert path == Path("/path/to/script")
 
 
-def test_bcda_runner():
+def test_parse_invalid_script_location():
+    with pytest.raises(ValueError):
+        manager.parse_script_location("a@b@c:d:/x")
+    with pytest.raises(ValueError):
+        manager.parse_script_location("myhost:relative/script")
+
+
+def test_ioc_status_from_response():
+    response = "25idc is running (pid=717809) in a screen session (pid=717808)"
+    assert manager.IOCStatus.from_response(response) == manager.IOCStatus.Running
+    response = "25idc is not running"
+    assert manager.IOCStatus.from_response(response) == manager.IOCStatus.Stopped
+    response = "bash: /path/to/script: No such file or directory"
+    assert manager.IOCStatus.from_response(response) == manager.IOCStatus.Unknown
+
+
+@pytest.mark.asyncio
+async def test_bcda_runner():
     runner = manager.BCDARunner(script_path=Path("/path/to/script"))
-    runner.execute_script = mock.MagicMock()
+    runner.execute_script = mock.AsyncMock()
     # Check that the start method executes commands
-    runner.start_ioc()
+    await runner.start_ioc()
     # Was the script executed?
     assert runner.execute_script.called
     assert runner.execute_script.call_args.kwargs["args"] == [
@@ -74,13 +132,13 @@ def test_bcda_runner():
     ]
     # Check that the stop method executes commands
     runner.execute_script.reset_mock()
-    runner.stop_ioc()
+    await runner.stop_ioc()
     # Was the script executed?
     assert runner.execute_script.called
     assert runner.execute_script.call_args.kwargs["args"] == ["/path/to/script", "stop"]
     # Check that the restart method executes commands
     runner.execute_script.reset_mock()
-    runner.restart_ioc()
+    await runner.restart_ioc()
     # Was the script executed?
     assert runner.execute_script.called
     assert runner.execute_script.call_args.kwargs["args"] == [
@@ -91,10 +149,282 @@ def test_bcda_runner():
     runner.execute_script.return_value = (
         "25idc is running (pid=717809) in a screen session (pid=717808)"
     )
-    assert runner.ioc_status() == manager.IOCStatus.Running
+    assert await runner.ioc_status() == manager.IOCStatus.Running
     # Check the status method returns the IOC status if off
     runner.execute_script.return_value = "25idc is not running"
-    assert runner.ioc_status() == manager.IOCStatus.Stopped
+    assert await runner.ioc_status() == manager.IOCStatus.Stopped
+    # Check the status is unknown if the script hangs
+    runner.execute_script.side_effect = exceptions.RemoteTimeout()
+    assert await runner.ioc_status() == manager.IOCStatus.Unknown
+    # Check the status is unknown if the host cannot be reached
+    runner.execute_script.side_effect = exceptions.RemoteConnectionError()
+    assert await runner.ioc_status() == manager.IOCStatus.Unknown
+
+
+@pytest.mark.asyncio
+async def test_bcda_runner_coalesces_status():
+    runner = manager.BCDARunner(script_path=Path("/path/to/script"))
+    runner.execute_script = mock.AsyncMock(return_value="25idc is running")
+    # Concurrent status requests should only run the script once
+    results = await asyncio.gather(runner.ioc_status(), runner.ioc_status())
+    assert results == [manager.IOCStatus.Running, manager.IOCStatus.Running]
+    assert runner.execute_script.await_count == 1
+    # Later requests should run the script again
+    await runner.ioc_status()
+    assert runner.execute_script.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_bcda_runner_executes_script():
+    runner = manager.BCDARunner(script_path=Path("/path/to/script"))
+    response = await runner.execute_script(["echo", "25idc is not running"])
+    assert response == "25idc is not running"
+    # Only the last line of output should be kept
+    response = await runner.execute_script(
+        ["printf", "Starting...\n25idc is running\n\n"]
+    )
+    assert response == "25idc is running"
+    # Overlong lines and bad bytes should not break the output parsing
+    response = await runner.execute_script(
+        [
+            sys.executable,
+            "-c",
+            "print('x' * 100_000); print('25idc is running')",
+        ]
+    )
+    assert response == "25idc is running"
+    response = await runner.execute_script(["printf", "\\377 is running\\n"])
+    assert response == "\ufffd is running"
+    # A script that closes its output but keeps running should time out
+    with mock.patch.object(manager, "RUNNER_TIMEOUT", 0.2):
+        with pytest.raises(exceptions.RemoteTimeout):
+            await runner.execute_script(["sh", "-c", "exec >&- 2>&-; sleep 10"])
+    # A missing script should raise a structured exception
+    with pytest.raises(exceptions.RemoteConnectionError):
+        await runner.execute_script(["/path/to/nonexistent/script", "status"])
+
+
+@pytest.mark.asyncio
+async def test_bcda_ssh_runner_reuses_connection():
+    conn = mock_ssh_connection("25idc is running\n")
+    runner_a = manager.BCDASSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    runner_b = manager.BCDASSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    with mock.patch.object(
+        manager.asyncssh, "connect", new=mock.AsyncMock(return_value=conn)
+    ) as connect:
+        response = await runner_a.execute_script(["/path/to/script", "status"])
+        await runner_b.execute_script(["/path/to/script", "status"])
+    # Both runners should have shared a single connection
+    assert connect.await_count == 1
+    # Host keys should be verified by default
+    assert "known_hosts" not in connect.call_args.kwargs
+    assert conn.create_process.call_count == 2
+    assert conn.create_process.call_args.args[0] == "/path/to/script status"
+    # Remote error messages should be included in the output
+    assert conn.create_process.call_args.kwargs["stderr"] == manager.asyncssh.STDOUT
+    assert response == "25idc is running"
+
+
+@pytest.mark.asyncio
+async def test_bcda_openssh_runner():
+    runner = manager.BCDAOpenSSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    with mock.patch.object(
+        manager.BCDARunner, "_run_subprocess", new=mock.AsyncMock(return_value=(0, ""))
+    ) as run_subprocess:
+        await runner.start_ioc()
+    args = run_subprocess.call_args.args[0]
+    assert args[0] == "ssh"
+    assert "ControlMaster=auto" in args
+    assert "BatchMode=yes" in args
+    assert "ConnectTimeout=5" in args
+    assert f"ControlPath={runner.control_path}" in args
+    assert args[-2:] == ["myuser@myhost", "/path/to/script start"]
+
+
+@pytest.mark.asyncio
+async def test_bcda_ssh_runner_limits_handshakes():
+    active = 0
+    peak = 0
+
+    async def slow_connect(host, **kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+        return mock_ssh_connection("25idc is running\n")
+
+    runners = [
+        manager.BCDASSHRunner(
+            user="myuser", host=f"host{i}", script_path=Path("/path/to/script")
+        )
+        for i in range(5)
+    ]
+    with (
+        mock.patch.object(manager, "_ssh_handshake_semaphore", asyncio.Semaphore(2)),
+        mock.patch.object(
+            manager.asyncssh, "connect", new=mock.AsyncMock(side_effect=slow_connect)
+        ) as connect,
+    ):
+        await asyncio.gather(
+            *(
+                runner.execute_script(["/path/to/script", "status"])
+                for runner in runners
+            )
+        )
+    assert connect.await_count == 5
+    assert peak == 2
+    # Pooled connections should not need the semaphore at all
+    with mock.patch.object(manager, "_ssh_handshake_semaphore", asyncio.Semaphore(0)):
+        response = await asyncio.wait_for(
+            runners[0].execute_script(["/path/to/script", "status"]), timeout=1
+        )
+    assert response == "25idc is running"
+
+
+@pytest.mark.asyncio
+async def test_bcda_ssh_runner_reconnects_lost_connection():
+    # The pooled connection has been lost, so opening a channel fails
+    stale_conn = mock_ssh_connection("")
+    stale_conn.is_closed.return_value = True
+    stale_conn.create_process.side_effect = manager.asyncssh.ChannelOpenError(
+        manager.asyncssh.OPEN_CONNECT_FAILED, "Connection lost"
+    )
+    fresh_conn = mock_ssh_connection("25idc is running\n")
+    runner = manager.BCDASSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    with mock.patch.object(
+        manager.asyncssh,
+        "connect",
+        new=mock.AsyncMock(side_effect=[stale_conn, fresh_conn]),
+    ) as connect:
+        response = await runner.execute_script(["/path/to/script", "status"])
+    # Exactly one reconnect, and the command ran once on the new connection
+    assert connect.await_count == 2
+    assert stale_conn.close.called
+    assert fresh_conn.create_process.await_count == 1
+    assert response == "25idc is running"
+
+
+@pytest.mark.asyncio
+async def test_bcda_ssh_runner_refused_channel_keeps_connection():
+    # sshd refused the channel, but the connection itself is healthy
+    conn = mock_ssh_connection("")
+    conn.create_process.side_effect = manager.asyncssh.ChannelOpenError(
+        manager.asyncssh.OPEN_ADMINISTRATIVELY_PROHIBITED, "Too many sessions"
+    )
+    runner = manager.BCDASSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    with mock.patch.object(
+        manager.asyncssh, "connect", new=mock.AsyncMock(return_value=conn)
+    ) as connect:
+        with pytest.raises(exceptions.RemoteConnectionError):
+            await runner.execute_script(["/path/to/script", "start"])
+    # The shared connection should not have been closed or replaced
+    assert connect.await_count == 1
+    assert not conn.close.called
+
+
+@pytest.mark.asyncio
+async def test_bcda_ssh_runner_does_not_rerun_started_command():
+    conn = mock_ssh_connection("")
+    # The connection drops while the command is already running
+    conn.create_process.side_effect = lambda cmd, **kwargs: FakeSSHProcess(
+        "Restarting 25idc\n", error=manager.asyncssh.ConnectionLost("Gone")
+    )
+    runner = manager.BCDASSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    with mock.patch.object(
+        manager.asyncssh, "connect", new=mock.AsyncMock(return_value=conn)
+    ) as connect:
+        with pytest.raises(exceptions.RemoteConnectionError):
+            await runner.execute_script(["/path/to/script", "restart"])
+    assert connect.await_count == 1
+    assert conn.create_process.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_bcda_ssh_runner_timeout():
+    conn = mock_ssh_connection("")
+
+    async def hang(cmd, **kwargs):
+        # Opening the channel never completes on a half-dead connection
+        await asyncio.sleep(10)
+
+    conn.create_process.side_effect = hang
+    runner = manager.BCDASSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    with (
+        mock.patch.object(
+            manager.asyncssh, "connect", new=mock.AsyncMock(return_value=conn)
+        ),
+        mock.patch.object(manager, "RUNNER_TIMEOUT", 0.2),
+    ):
+        with pytest.raises(exceptions.RemoteTimeout):
+            await runner.execute_script(["/path/to/script", "status"])
+
+
+@pytest.mark.asyncio
+async def test_bcda_ssh_runner_quotes_arguments():
+    conn = mock_ssh_connection("")
+    runner = manager.BCDASSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/my script")
+    )
+    with mock.patch.object(
+        manager.asyncssh, "connect", new=mock.AsyncMock(return_value=conn)
+    ):
+        await runner.execute_script(["/path/to/my script", "status; rm -rf ~"])
+    assert (
+        conn.create_process.call_args.args[0]
+        == "'/path/to/my script' 'status; rm -rf ~'"
+    )
+
+
+def test_bcda_openssh_runner_registers_cleanup_once():
+    with (
+        mock.patch.object(manager, "_ssh_control_paths", set()),
+        mock.patch.object(manager.atexit, "register") as register,
+    ):
+        runner_a = manager.BCDAOpenSSHRunner(
+            user="myuser", host="myhost", script_path=Path("/path/to/script")
+        )
+        runner_b = manager.BCDAOpenSSHRunner(
+            user="myuser", host="myhost", script_path=Path("/path/to/other_script")
+        )
+        assert runner_a.control_path == runner_b.control_path
+        assert register.call_count == 1
+        # Long host names should still give a usable socket path
+        runner = manager.BCDAOpenSSHRunner(
+            user="myuser", host="a" * 200, script_path=Path("/path/to/script")
+        )
+        assert len(str(runner.control_path)) < 108
+
+
+@pytest.mark.asyncio
+async def test_bcda_openssh_runner_connection_error():
+    runner = manager.BCDAOpenSSHRunner(
+        user="myuser", host="myhost", script_path=Path("/path/to/script")
+    )
+    # Stand-in for ssh failing to reach the host
+    fake_ssh = [
+        "sh",
+        "-c",
+        "echo 'ssh: connect to host myhost port 22: Connection refused'; exit 255",
+        "ssh",
+    ]
+    with mock.patch.object(runner, "ssh_args", return_value=fake_ssh):
+        with pytest.raises(exceptions.RemoteConnectionError):
+            await runner.start_ioc()
 
 
 def test_manager_loads_runner():
@@ -110,6 +440,11 @@ def test_manager_loads_runner():
     assert ssh_manager.runner.user == "myuser"
     assert ssh_manager.runner.host == "myhost"
     assert ssh_manager.runner.script_path == Path("/path/to/script")
+    # Managers for the same script should share a runner
+    other_manager = manager.ManagerGroup(
+        prefix="other_manager", script="myuser@myhost:/path/to/script"
+    )
+    assert other_manager.runner is ssh_manager.runner
 
 
 @pytest.mark.asyncio
@@ -119,6 +454,14 @@ async def test_start_ioc(mock_manager):
     assert mock_manager.runner.start_ioc.called
 
 
+@pytest.mark.asyncio
+async def test_start_ioc_timeout(mock_manager):
+    mock_manager.runner.start_ioc.side_effect = exceptions.RemoteTimeout()
+    # The write should be skipped, not raise
+    await mock_manager.start.write(1)
+    assert mock_manager.start.value == "Off"
+
+
 @pytest.mark.asyncio
 async def test_stop_ioc(mock_manager):
     await mock_manager.stop.write(1)